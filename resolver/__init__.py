@@ -1 +1,3 @@
-from . import parser, utils
+# Submodules are intentionally not imported here: importing resolver.utils
+# pulls in pysat, which short-lived CLI commands like `resolver latest`
+# don't need. Import resolver.parser / resolver.utils directly.
@@ -1,71 +1,102 @@
-from .parser import load_package_index
-from .utils import latest_version, satisfy
+import sys
 
-from argparse import ArgumentParser
+USAGE = """\
+usage: resolver -I/--index PATH [--mode MODE] SUBCOMMAND ...
 
+subcommands:
+  latest PACKAGE                show latest version of package
+  satisfy PACKAGE VERSION       satisfy dependencies of requested package
 
-def show_latest_version(index, package: str):
-    if package not in index.keys():
+options:
+  -I PATH, --index PATH  path to package index (required)
+  --mode MODE            mode of handling multiple dependencies of a versioned
+                         package on a single package. Can be either
+                         "intersection" (default) or "union".
+  --oneline              print result of satisfy as single line of
+                         comma-delimited list of versioned packages
+  -h, --help             show this help message
+"""
+
+
+def show_latest_version(latest, package: str):
+    if package not in latest:
         print(f"There is no package named '{package}'")
         # TODO: suggest name of lexicographically nearest package
         return
 
-    v = latest_version(index, package)
-    print(v)
+    # looked up here directly so that the `latest` subcommand doesn't
+    # import resolver.utils (and pysat with it)
+    print(latest[package])
+
+
+def error(message):
+    print(f"resolver: {message}", file=sys.stderr)
+    exit(2)
 
 
 def main():
-    parser = ArgumentParser(prog="resolver")
-    subparsers = parser.add_subparsers(dest="subcommand")
-
-    # TODO: path to the index of packages may be stored in environmental variable
-    parser.add_argument(
-        "-I",
-        "--index",
-        dest="path",
-        required=True,
-        help="path to package index",
-    )
-    parser.add_argument(
-        "--mode",
-        dest="mode",
-        default="intersection",
-        help='mode of handling multiple dependencies of a versioned package on a single package. Can be either "intersection" or "union".',
-    )
+    # Arguments are parsed by hand instead of by argparse: for a tool with
+    # two subcommands and three options, importing and configuring argparse
+    # costs more than the parsing itself, and it is paid on every
+    # invocation.
+    options = {"--mode": "intersection", "--oneline": False}
+    positional = []
 
-    subcommand_latest = subparsers.add_parser(
-        "latest", help="show latest version of package"
-    )
-    subcommand_latest.add_argument("package", help="package name")
+    args = sys.argv[1:]
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ("-h", "--help"):
+            print(USAGE, end="")
+            return
+        elif arg in ("-I", "--index", "--mode"):
+            if i + 1 == len(args):
+                error(f"option {arg} requires a value")
+            options["--index" if arg == "-I" else arg] = args[i + 1]
+            i += 2
+        elif arg == "--oneline":
+            options[arg] = True
+            i += 1
+        elif arg.startswith("-"):
+            error(f"unknown option {arg}")
+        else:
+            positional.append(arg)
+            i += 1
 
-    subcommand_satisfy = subparsers.add_parser(
-        "satisfy", help="satisfy dependencies of requested package"
-    )
-    subcommand_satisfy.add_argument("package", help="package name")
-    subcommand_satisfy.add_argument("version", help="package version")
-    subcommand_satisfy.add_argument(
-        "--oneline",
-        dest="oneline",
-        action="store_true",
-        help="print result as single line of comma-delimited list of versioned packages",
+    if not positional:
+        print(USAGE, end="")
+        return
+    if "--index" not in options:
+        error("the following arguments are required: -I/--index")
+
+    subcommand, *arguments = positional
+
+    # imports happen after the subcommand is known, so that e.g. --help and
+    # `latest` don't pay for modules only `satisfy` needs
+    from .parser import load_package_index_cached
+
+    index, dependencies, latest = load_package_index_cached(
+        options["--index"], mode=options["--mode"]
     )
 
-    args = parser.parse_args()
-    if args.subcommand is None:
-        parser.print_help()
-        exit()
+    if subcommand == "latest":
+        if len(arguments) != 1:
+            error("usage: resolver latest PACKAGE")
+        show_latest_version(latest, arguments[0])
+    elif subcommand == "satisfy":
+        if len(arguments) != 2:
+            error("usage: resolver satisfy PACKAGE VERSION [--oneline]")
+        from .utils import satisfy
 
-    index, dependencies = load_package_index(args.path, mode=args.mode)
-    if args.subcommand == "latest":
-        show_latest_version(index, args.package)
-    elif args.subcommand == "satisfy":
         satisfy(
             index,
             dependencies,
-            args.package,
-            args.version,
-            oneline=args.oneline,
+            arguments[0],
+            arguments[1],
+            oneline=options["--oneline"],
         )
+    else:
+        error(f"unknown subcommand '{subcommand}'")
 
 
 if __name__ == "__main__":
@@ -1,16 +1,27 @@
-from dataclasses import dataclass
-from collections import defaultdict
+import hashlib
+import mmap
+import os
+import pickle
+import re
+import sys
+from array import array
+from functools import cached_property
+from bisect import bisect_left
 
 # PART 1: abstraction definitions
 
 
-@dataclass(frozen=True)
 class Version:
     """Representation of version of a package
 
-    Supports only single-number version"""
+    Supports only single-number version. Plain __slots__ class instead of
+    a dataclass: instances are created per version per line during parse,
+    so skipping per-instance __dict__ saves both memory and time."""
 
-    v: int
+    __slots__ = ("v",)
+
+    def __init__(self, v: int):
+        self.v = v
 
     def __lt__(self, other):
         return self.v < other.v
@@ -21,27 +32,48 @@ class Version:
     def __eq__(self, other):
         return self.v == other.v
 
+    def __hash__(self):
+        return hash(self.v)
+
     def __str__(self):
         return str(self.v)
 
+    def __repr__(self):
+        return f"Version({self.v})"
+
 
-@dataclass(frozen=True)
 class VersionRange:
     """Closed non-empty range of versions"""
 
-    start: Version
-    end: Version
+    __slots__ = ("start", "end")
 
-    def __post_init__(self):
-        if self.end < self.start:
+    def __init__(self, start: Version, end: Version):
+        if end < start:
             raise Exception(
                 "End version of VersionRange should be at least start version"
             )
+        self.start = start
+        self.end = end
+
+    def __eq__(self, other):
+        return self.start == other.start and self.end == other.end
+
+    def __hash__(self):
+        return hash((self.start, self.end))
+
+    def __repr__(self):
+        return f"VersionRange({self.start!r}, {self.end!r})"
+
+    def intersects(self, other):
+        """Test whether two ranges share at least one version"""
+        return self.start.v <= other.end.v and other.start.v <= self.end.v
 
     def union(self, other):
         """Returns union of two intersecting ranges"""
-        if self.end < other.start or other.end < self.start:
-            raise Exception  # TODO: specify
+        if not self.intersects(other):
+            raise ValueError(
+                f"Can't unite disjunct ranges {self} and {other}"
+            )
 
         return VersionRange(
             min(self.start, other.start), max(self.end, other.end)
@@ -53,71 +85,166 @@ class VersionRange:
         return f"{self.start.v}..{self.end.v}"
 
     def __contains__(self, item: Version):
-        return self.start <= item <= self.end
+        # compare underlying ints directly, bypassing Version method
+        # dispatch in this frequently-called check
+        return self.start.v <= item.v <= self.end.v
+
+
+def _merge_pairs(pairs):
+    """Fold sorted (start, end) int pairs into disjunct boundary arrays
+
+    The normalization kernel of VersionSet: overlapping pairs are fused
+    into one range. Kept as a standalone function on plain ints so it can
+    be replaced by a compiled implementation without touching VersionSet.
+
+    Returns:
+        (starts, ends): parallel array('q') columns of the merged ranges
+    """
+    starts, ends = array("q"), array("q")
+    if not pairs:
+        return starts, ends
+
+    cur_start, cur_end = pairs[0]
+    for s, e in pairs:
+        if cur_end < s:
+            starts.append(cur_start)
+            ends.append(cur_end)
+            cur_start, cur_end = s, e
+        elif e > cur_end:
+            cur_end = e
+    starts.append(cur_start)
+    ends.append(cur_end)
+    return starts, ends
+
+
+def _boundaries_mask(starts, ends):
+    """Bitmask of versions covered by sorted disjunct boundary arrays
+
+    Bit v of the result is set iff version v belongs to one of the ranges.
+    """
+    mask = 0
+    for s, e in zip(starts, ends):
+        mask |= ((1 << (e - s + 1)) - 1) << s
+    return mask
 
 
 class VersionSet:
     """Set of versions
 
-    VersionSet is stored as an ordered sequence of disjunct version ranges
-    (see VersionRange). Note: while Version and VersionRange are
-    immutable, VersionSet is not.
+    VersionSet is stored as an ordered sequence of disjunct version ranges,
+    kept in two parallel int arrays (`starts`/`ends`), so containment and
+    set operations run on C-level integer comparisons instead of chasing
+    pointers through per-range objects. The `ranges` view of VersionRange
+    objects is materialized lazily for callers that want it.
+    Note: while Version and VersionRange are immutable, VersionSet is not.
     """
 
-    # TODO: make ranges sorted and disjunct
-
     def __init__(self, ranges: list[VersionRange] = None):
-        if ranges is None:
-            ranges = []
-
-        self.ranges = []
-
-        if not ranges:
-            return
-
-        ranges.sort(key=lambda r: r.start)
-        current = ranges[0]
-        for r in ranges:
-            if current.end < r.start:
-                self.ranges.append(
-                    current
-                )  # note that VersionRange is frozen dataclass
-                current = r
-            else:
-                current = current.union(r)
-        self.ranges.append(current)
+        # the union fold runs on raw (start, end) int pairs (see
+        # _merge_pairs); VersionRange objects are materialized only for
+        # ranges that survive it, not per merge step
+        pairs = sorted((r.start.v, r.end.v) for r in ranges) if ranges else []
+        self._set_boundaries(*_merge_pairs(pairs))
+
+    def _set_boundaries(self, starts, ends):
+        """Initialize representations from sorted disjunct boundary arrays"""
+        self.starts = starts
+        self.ends = ends
+
+    @cached_property
+    def mask(self):
+        """Bitmask of versions in the set (bit v is set iff Version(v) is in)
+
+        Built on first access: the mask is as wide as the largest version
+        value, so for date- or timestamp-style versions it is huge, and
+        intermediate sets from union/intersection should never pay for
+        it. Callers working with such versions should stay on the
+        boundary arrays (see _dependency_clauses in resolver.utils).
+        """
+        return _boundaries_mask(self.starts, self.ends)
+
+    @cached_property
+    def ranges(self):
+        """Ranges of this set as a list of VersionRange objects
+
+        Built on first access: the set operations themselves only touch
+        the boundary arrays.
+        """
+        return [
+            VersionRange(Version(s), Version(e))
+            for s, e in zip(self.starts, self.ends)
+        ]
+
+    @classmethod
+    def _from_sorted_arrays(cls, starts, ends):
+        """Construct VersionSet from boundary arrays of sorted disjunct ranges
+
+        Bypasses normalization done by __init__ — callers must guarantee
+        that ranges are already sorted and disjunct.
+        """
+        vs = cls.__new__(cls)
+        vs._set_boundaries(starts, ends)
+        return vs
 
     def union(self, other):
-        # TODO: can be done in linear time, but this is quick enough
         # TODO: don't forget about this method when implementing unclosed VersionRange
-        return VersionSet(self.ranges + other.ranges)
+        # linear two-pointer merge of two sorted disjunct boundary
+        # sequences; overlapping ranges are fused with the same running
+        # `current` logic as in __init__, without the re-sort
+        left_starts, left_ends = self.starts, self.ends
+        right_starts, right_ends = other.starts, other.ends
+        starts, ends = array("q"), array("q")
 
-    def intersection(self, other):
-        ranges = []
         i, j = 0, 0
-        while i < len(self.ranges) and j < len(other.ranges):
-            left = self.ranges[i]
-            right = other.ranges[j]
+        cur_start = cur_end = None
+        while i < len(left_starts) or j < len(right_starts):
+            if j >= len(right_starts) or (
+                i < len(left_starts) and left_starts[i] <= right_starts[j]
+            ):
+                s, e = left_starts[i], left_ends[i]
+                i += 1
+            else:
+                s, e = right_starts[j], right_ends[j]
+                j += 1
+
+            if cur_start is None:
+                cur_start, cur_end = s, e
+            elif cur_end < s:
+                starts.append(cur_start)
+                ends.append(cur_end)
+                cur_start, cur_end = s, e
+            elif e > cur_end:
+                cur_end = e
+        if cur_start is not None:
+            starts.append(cur_start)
+            ends.append(cur_end)
+        return VersionSet._from_sorted_arrays(starts, ends)
+
+    def intersection(self, other):
+        # two-pointer merge over boundary arrays; resulting ranges are
+        # sorted and disjunct by construction, so normalization is skipped
+        left_starts, left_ends = self.starts, self.ends
+        right_starts, right_ends = other.starts, other.ends
+        starts, ends = array("q"), array("q")
 
-            if left.end < right.start:
+        i, j = 0, 0
+        while i < len(left_starts) and j < len(right_starts):
+            if left_ends[i] < right_starts[j]:
                 i += 1
                 continue
-            if right.end < left.start:
+            if right_ends[j] < left_starts[i]:
                 j += 1
                 continue
 
             # now we know that two ranges intersect
-            if left.end < right.end:
-                ranges.append(
-                    VersionRange(max(left.start, right.start), left.end)
-                )
+            starts.append(max(left_starts[i], right_starts[j]))
+            if left_ends[i] < right_ends[j]:
+                ends.append(left_ends[i])
                 i += 1
             else:
-                ranges.append(
-                    VersionRange(max(left.start, right.start), right.end)
-                )
+                ends.append(right_ends[j])
                 j += 1
-        return VersionSet(ranges)
+        return VersionSet._from_sorted_arrays(starts, ends)
 
     def pick(self, versions):  # TODO: add typehint iterable
         """Pick versions from iterable present in this VersionSet
@@ -125,27 +252,74 @@ class VersionSet:
         Returns:
             result (iterable)
         """
-
-        return set(filter(self.__contains__, versions))
+        # inlined __contains__: one bisect over the boundary arrays per
+        # candidate, without a Python-level method call each
+        starts, ends = self.starts, self.ends
+        n = len(starts)
+
+        picked = set()
+        for version in versions:
+            i = bisect_left(ends, version.v)
+            if i < n and starts[i] <= version.v:
+                picked.add(version)
+        return picked
 
     def __contains__(self, item: Version):
-        for r in self.ranges:
-            if item in r:
-                return True
-        return False
+        # index of the first range which ends at item.v or later
+        i = bisect_left(self.ends, item.v)
+        return i < len(self.starts) and self.starts[i] <= item.v
+
+    def __str__(self):
+        return ", ".join(map(str, self.ranges))
 
     def __repr__(self):
         return f"VersionSet({self.ranges})"
 
 
-@dataclass(frozen=True)  # frozen=True makes objects hashable
 class VersionedPackage:
-    name: str
-    version: Version
+    """Package name together with one concrete version
+
+    Hashable, so it can be used as dict key (e.g. in `dependencies`
+    mappings and in Formula's bijection)."""
+
+    __slots__ = ("name", "version")
+
+    def __init__(self, name: str, version: Version):
+        self.name = name
+        self.version = version
+
+    def __eq__(self, other):
+        return self.name == other.name and self.version == other.version
+
+    def __hash__(self):
+        return hash((self.name, self.version))
+
+    def __repr__(self):
+        return f"VersionedPackage({self.name!r}, {self.version!r})"
 
 
 # PART 2: package index supporting functions (nothing more than parsing)
 
+# Precompiled patterns for index entries. Parsing with a single match per
+# line (plus one findall over the dependencies tail) avoids the chain of
+# str.strip/str.split calls and their intermediate allocations, which
+# dominate parse time on large indices.
+_ENTRY_RE = re.compile(r"\s*(\S+)\s+(\d+)\s*:(.*)")
+_DEP_RE = re.compile(r"([^\s,]+)\s+(\d+)(?:\.\.(\d+))?")
+
+# Bytes counterparts of the patterns above, used by load_package_index to
+# scan a memory-mapped index without creating a str object per line.
+# [ \t] instead of \s keeps an entry match confined to a single line.
+_ENTRY_RE_B = re.compile(rb"(\S+)[ \t]+(\d+)[ \t]*:([^\n]*)", re.ASCII)
+_DEP_RE_B = re.compile(rb"([^\s,]+)[ \t]+(\d+)(?:\.\.(\d+))?", re.ASCII)
+
+# findall with _DEP_RE would silently drop malformed dependencies, so the
+# whole tail is checked against 'item(, item)*' (or blank) first and
+# anything else is rejected.
+_DEP_ITEM = r"[^\s,]+\s+\d+(?:\.\.\d+)?"
+_DEPS_TAIL_RE = re.compile(rf"\s*(?:{_DEP_ITEM}\s*(?:,\s*{_DEP_ITEM}\s*)*)?")
+_DEPS_TAIL_RE_B = re.compile(_DEPS_TAIL_RE.pattern.encode("ascii"), re.ASCII)
+
 
 def parse_version(s):
     """Parse version string
@@ -167,51 +341,13 @@ def parse_range(s):
     Returns:
         version_range (VersionRange)
     """
-    if ".." in s:
-        start_, end_ = s.split("..")
+    # partition scans the string once, unlike the `".." in s` check
+    # followed by a split
+    start_, sep, end_ = s.partition("..")
+    if sep:
         return VersionRange(parse_version(start_), parse_version(end_))
-    else:
-        v = parse_version(s)
-        return VersionRange(v, v)
-
-
-def parse_package_version(s):
-    """Parse string denoting versioned package
-
-    Syntax:
-        '<package_name> <version>'
-    Returns:
-        versioned_package (VersionedPackage)
-    """
-    name, version = s.strip().split()
-    return VersionedPackage(name, parse_version(version))
-
-
-def parse_dependency(s):
-    """Parse single dependency
-
-    Syntax:
-        '<package_name> <version_range>'
-    Returns:
-        name (str), range (VersionRange)
-    """
-    name, range_ = s.split()
-    return name, parse_range(range_)
-
-
-def parse_dependencies(s):
-    """Parse list of dependencies
-
-    Syntax:
-        '<dependency>, ..., <dependency>'
-    Returns:
-        dependencies (List[Tuple[str, VersionRange]])
-    """
-    deps = s.strip().split(",")
-    if deps == [""]:  # no dependencies
-        return []
-
-    return [parse_dependency(dep.strip()) for dep in deps]
+    v = parse_version(start_)
+    return VersionRange(v, v)
 
 
 def parse_entry(entry):
@@ -219,12 +355,22 @@ def parse_entry(entry):
 
     Syntax:
         '<package_name> <version>: <dependency>, ..., <dependency>'
+        where each dependency is '<package_name> <version_range>'
     Returns:
         result (Tuple[VersionedPackage], List[Tuple[str, VersionRange]])
     """
-    package, dependencies = entry.strip().split(":")
+    m = _ENTRY_RE.match(entry)
+    if m is None:
+        raise Exception(f"Invalid package index entry: {entry!r}")
+    name, version, tail = m.groups()
+    if _DEPS_TAIL_RE.fullmatch(tail) is None:
+        raise Exception(f"Invalid package index entry: {entry!r}")
 
-    return parse_package_version(package), parse_dependencies(dependencies)
+    dependencies = [
+        (dep, VersionRange(Version(int(start)), Version(int(end or start))))
+        for dep, start, end in _DEP_RE.findall(tail)
+    ]
+    return VersionedPackage(name, Version(int(version))), dependencies
 
 
 # PART 3: actual logic of parser
@@ -243,45 +389,148 @@ def load_package_index(path, mode="intersection"):
             "union" mode, in the same situation, version of B in setup
             should be in one of them.
 
-    Returns: (index, dependencies)
+    Returns: (index, dependencies, latest)
         index (dict[str, set[Version]]): index of versions of packages, where
             key is package name and  value is version number.
         dependencies (dict[VersionedPackage, dict[str, VersionSet]]): dict,
             where keys are versioned packages and values are mappings from
             package names  this version depend on to set of possible versions
             for this dependency.
+        latest (dict[str, Version]): latest version of each package,
+            maintained incrementally during the parse so that the `latest`
+            subcommand answers in O(1) instead of scanning index[package].
     """
-    multiple_ranges_handler = {
-        "intersection": lambda vs, new_range: vs.intersection(
-            VersionSet([new_range])
-        ),
-        "union": lambda vs, new_range: vs.union(VersionSet([new_range])),
-    }[
-        mode
-    ]  # TODO: Add handling of invalid modes?
+    if mode not in ("intersection", "union"):
+        raise Exception(f"Unknown mode '{mode}'")
 
     index = {}
     dependencies = {}
-    with open(path, "r") as file:
-        for line in file:
-            pv, raw_deps = parse_entry(line)
+    latest = {}
+    with open(path, "rb") as file:
+        # mmap the index instead of iterating lines of a text file: this
+        # avoids allocating and utf-8-decoding a str per line, only the
+        # captured fields are decoded (as plain ascii)
+        if os.fstat(file.fileno()).st_size == 0:
+            return index, dependencies, latest
+        buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with buf:
+        # finditer happily jumps over bytes no entry matches; `pos` tracks
+        # the end of the previous match so that anything between matches
+        # (and after the last one) other than whitespace is rejected, like
+        # a malformed line would have been when parsing line by line
+        pos = 0
+        for entry in _ENTRY_RE_B.finditer(buf):
+            gap = buf[pos : entry.start()]
+            if gap.strip():
+                raise Exception(
+                    "Invalid package index entry:"
+                    f" {gap.strip().decode('ascii', 'replace')!r}"
+                )
+            pos = entry.end()
+            # the same package names occur over and over across the index;
+            # interning collapses the copies into one str object and makes
+            # later dict lookups on them identity-fast
+            pv = VersionedPackage(
+                sys.intern(entry.group(1).decode("ascii")),
+                Version(int(entry.group(2))),
+            )
+            tail = entry.group(3)
+            if _DEPS_TAIL_RE_B.fullmatch(tail) is None:
+                raise Exception(
+                    "Invalid package index entry:"
+                    f" {entry.group().decode('ascii', 'replace')!r}"
+                )
+            raw_deps = [
+                (
+                    sys.intern(dep.decode("ascii")),
+                    VersionRange(Version(int(start)), Version(int(end or start))),
+                )
+                for dep, start, end in _DEP_RE_B.findall(tail)
+            ]
 
             # Adding index entry
-            if pv.name not in index.keys():
-                index[pv.name] = set()
-            if pv.version in index[pv.name]:
+            versions = index.setdefault(pv.name, set())
+            if pv.version in versions:
                 # Different lines specify dependencies of same version
                 raise Exception(
                     f"{pv.name} {pv.version} dependencies are specified twice"
                 )
-            index[pv.name].add(pv.version)
+            versions.add(pv.version)
+            if pv.name not in latest or latest[pv.name] < pv.version:
+                latest[pv.name] = pv.version
+
+            # Adding dependencies entries. Ranges are grouped per required
+            # package first and each group becomes a VersionSet in one go,
+            # instead of constructing and merging a throwaway VersionSet
+            # per duplicate dependency edge.
+            grouped = {}
+            for name, vr in raw_deps:
+                grouped.setdefault(name, []).append(vr)
 
-            # Adding dependencies entries
             deps = {}
-            for name, vr in raw_deps:
-                if name in deps.keys():
-                    deps[name] = multiple_ranges_handler(deps[name], vr)
+            for name, ranges in grouped.items():
+                if mode == "union" or len(ranges) == 1:
+                    # normalization in VersionSet.__init__ sorts and unions
+                    # the ranges, which is exactly "union" semantics
+                    deps[name] = VersionSet(ranges)
                 else:
-                    deps[name] = VersionSet([vr])
+                    # intersection of closed ranges is again a closed range
+                    start = max(r.start.v for r in ranges)
+                    end = min(r.end.v for r in ranges)
+                    deps[name] = VersionSet(
+                        [VersionRange(Version(start), Version(end))]
+                        if start <= end
+                        else []
+                    )
             dependencies[pv] = deps
-    return index, dependencies
+
+        tail = buf[pos:]
+        if tail.strip():
+            raise Exception(
+                "Invalid package index entry:"
+                f" {tail.strip().decode('ascii', 'replace')!r}"
+            )
+    return index, dependencies, latest
+
+
+_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "resolver")
+
+
+def load_package_index_cached(path, mode="intersection"):
+    """Load package index, memoizing parsed results on disk
+
+    Parsing is deterministic in the file contents and mode, so the parsed
+    result is pickled into ~/.cache/resolver keyed by the absolute path,
+    mtime and size of the index file. Repeated CLI invocations against an
+    unchanged index then skip parsing entirely. Falls back to
+    load_package_index whenever the cache can't be read or written.
+
+    Arguments and returned values are the same as of load_package_index.
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size, mode)
+    digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+    cache_path = os.path.join(_CACHE_DIR, f"{digest}.pkl")
+
+    try:
+        with open(cache_path, "rb") as file:
+            cached_key, index, dependencies, latest = pickle.load(file)
+        if cached_key == key:
+            return index, dependencies, latest
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        pass
+
+    index, dependencies, latest = load_package_index(path, mode=mode)
+
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        with open(cache_path, "wb") as file:
+            pickle.dump(
+                (key, index, dependencies, latest),
+                file,
+                pickle.HIGHEST_PROTOCOL,
+            )
+    except OSError:
+        pass  # caching is best-effort, the parsed result is still valid
+    return index, dependencies, latest
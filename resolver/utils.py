@@ -1,17 +1,34 @@
-from itertools import combinations
+from bisect import bisect_left
 from collections.abc import Iterable
 from collections import deque
+from functools import cached_property
 
 from pysat.formula import CNF
 from pysat.solvers import Solver
 
 from .parser import parse_version, Version, VersionedPackage, VersionSet
 
+# pysat backend used for Formula queries. Cadical is a modern CDCL solver
+# which handles incremental solving under assumptions well; the pysat
+# default (minisat22) is noticeably slower on repeated queries.
+SOLVER_BACKEND = "cadical153"
+
+# Largest version value for which _dependency_clauses picks versions via
+# VersionSet.mask. The mask is one bit per version value, so beyond this
+# (8 KiB of mask) bisecting the boundary arrays is both leaner and
+# faster than materializing masks for e.g. timestamp-style versions.
+_DENSE_VERSION_LIMIT = 1 << 16
+
 
 class UnknownPackageError(Exception):
     pass
 
 
+# raised when requested version of a package is absent in the index
+class UnknownVersionError(Exception):
+    pass
+
+
 # raised when presumably valid setup has unsatisfied dependency
 class UnsatisfiedDependencyError(Exception):
     pass
@@ -22,19 +39,225 @@ class MultipleVersionsError(Exception):
     pass
 
 
-def latest_version(index, package: str):
-    if package not in index.keys():
+def latest_version(latest, package: str):
+    """Latest version of a package
+
+    `latest` is the per-package mapping of latest versions maintained by
+    load_package_index, so the query is a single dict lookup.
+    """
+    if package not in latest:
         raise UnknownPackageError
-    return max(index[package])
+    return latest[package]
+
+
+def _reachable(index, dependencies, root_vp):
+    """Collect versioned packages transitively reachable from root_vp
+
+    A versioned package is reachable if it is root_vp itself or if it can
+    satisfy a dependency of some reachable versioned package.
+
+    Returns:
+        reachable (set[VersionedPackage])
+    """
+    reachable = {root_vp}
+    queue = deque([root_vp])
+    while queue:
+        vp = queue.popleft()
+        for name, vs in dependencies[vp].items():
+            for v in index.get(name, ()):
+                if v not in vs:
+                    continue
+                candidate = VersionedPackage(name, v)
+                if candidate not in reachable:
+                    reachable.add(candidate)
+                    queue.append(candidate)
+    return reachable
+
+
+def _at_most_one(lits, next_id, emit):
+    """Emit clauses allowing at most one of lits to be true
+
+    Sequential (Sinz) encoding: auxiliary variable s_i means "one of the
+    first i literals is true", giving O(n) clauses and auxiliary variables
+    instead of the O(n^2) clauses of the naive pairwise encoding.
+    Auxiliary variables are allocated starting from next_id; clauses are
+    passed to `emit` one by one.
+
+    Returns:
+        next_id (int): the next free auxiliary variable id
+    """
+    n = len(lits)
+    if n < 2:
+        return next_id
+    if n == 2:
+        # the single pairwise clause beats the ladder here: no auxiliary
+        # variable and one clause instead of two
+        emit([-lits[0], -lits[1]])
+        return next_id
+
+    s = range(next_id, next_id + n - 1)
+    emit([-lits[0], s[0]])
+    for i in range(1, n - 1):
+        emit([-lits[i], s[i]])
+        emit([-s[i - 1], s[i]])
+        emit([-lits[i], -s[i - 1]])
+    emit([-lits[n - 1], -s[n - 2]])
+    return next_id + n - 1
+
+
+def _version_uniqueness_clauses(var_of, next_id, emit):
+    """Emit clauses prohibiting several versions of the same package
+
+    One at-most-one constraint per package, over the variables of its
+    versions. Auxiliary variables are allocated starting from next_id;
+    the next free id is returned.
+    """
+    for pkg_vars in var_of.values():
+        next_id = _at_most_one(list(pkg_vars.values()), next_id, emit)
+    return next_id
+
+
+def _dependency_clauses(bijection, dependencies, var_of, emit):
+    """Emit clauses checking that dependencies are satisfied
+
+    For every (vp, requirement) pair: either one of the versions
+    satisfying the dependency is present in the setup, or vp is absent.
+    When no version can satisfy the dependency, the clause degenerates
+    to the unit clause [-var], permanently disabling vp.
+    """
+    # Bitmask of versions present in the formula per package, aligned
+    # with VersionSet.mask: AND of the two masks gives versions
+    # satisfying a dependency without a per-version containment check.
+    # Masks are as wide as the largest version value, so they are built
+    # lazily per package and only below _DENSE_VERSION_LIMIT; date-style
+    # versions (e.g. 20240101) fall back to bisecting the boundary
+    # arrays instead of materializing megabytes of mask. None marks a
+    # package whose versions are too large for the mask path.
+    index_masks = {}
+
+    # The same (requirement, versionset) dependency typically occurs in
+    # many versioned packages; its literal list is computed once and
+    # shared across them. The boundary arrays identify the set exactly,
+    # so their raw bytes work as the cache key.
+    literals_cache = {}
+    for vp, var in bijection.items():
+        for requirement, vs in dependencies[vp].items():
+            cache_key = (
+                requirement,
+                vs.starts.tobytes(),
+                vs.ends.tobytes(),
+            )
+            literals = literals_cache.get(cache_key)
+            if literals is None:
+                vmap = var_of.get(requirement, {})
+                im = index_masks.get(requirement, False)
+                if im is False:
+                    im = (
+                        sum(1 << v for v in vmap)
+                        if all(v < _DENSE_VERSION_LIMIT for v in vmap)
+                        else None
+                    )
+                    index_masks[requirement] = im
+
+                literals = []
+                if im is not None and (
+                    not vs.ends or vs.ends[-1] < _DENSE_VERSION_LIMIT
+                ):
+                    m = vs.mask & im
+                    while m:
+                        bit = m & -m
+                        literals.append(vmap[bit.bit_length() - 1])
+                        m ^= bit
+                else:
+                    starts, ends = vs.starts, vs.ends
+                    n = len(starts)
+                    for v, lit in vmap.items():
+                        i = bisect_left(ends, v)
+                        if i < n and starts[i] <= v:
+                            literals.append(lit)
+                literals_cache[cache_key] = literals
+
+            # A self-dependency satisfied by vp itself gives the
+            # tautology (var | ... | -var) — no point emitting it.
+            # (Clauses whose versionset covers every available version
+            # of the requirement can NOT be dropped: the encoding has
+            # no at-least-one clauses, so a setup is free to omit the
+            # requirement entirely unless this clause forbids it.)
+            if requirement == vp.name and var in literals:
+                continue
+
+            emit(literals + [-var])
 
 
 class Formula:
     """Wrapper around pysat.formula with better interface"""
 
-    def __init__(self, formula: CNF, bijection: dict[VersionedPackage, int]):
-        self.formula = formula
+    def __init__(
+        self,
+        clauses: list[list[int]] | None,
+        bijection: dict[VersionedPackage, int],
+        solver: Solver | None = None,
+        top_id: int | None = None,
+    ):
+        # raw clause list; None when the clauses were streamed straight
+        # into `solver` and never materialized on the Python side
+        self._clauses = clauses
         self.vp_to_var = bijection
-        self.var_to_vp = dict(map(reversed, bijection.items()))
+        # highest variable id occurring in the formula; fresh variables
+        # (e.g. selectors in any_satisfiable) are allocated after it
+        if top_id is None:
+            top_id = len(bijection)
+        self._top_id = top_id
+        # long-lived incremental solver: either the one clauses were
+        # streamed into (see from_dependencies), or bootstrapped lazily
+        # from self.formula on the first query. Re-used by all queries, so
+        # clause loading is paid once. Owned by the Formula; release it
+        # with close() or by using the Formula as a context manager.
+        self._solver = solver
+
+    @cached_property
+    def var_to_vp(self):
+        """Inverse of vp_to_var
+
+        Built lazily: only model decoding in solve() needs it, queries like
+        any_satisfiable never pay for its construction.
+        """
+        return {var: vp for vp, var in self.vp_to_var.items()}
+
+    @cached_property
+    def formula(self):
+        """CNF view of the clauses, materialized on first access
+
+        Internal queries load the raw clause list into the solver
+        directly; the CNF object only exists for external callers that
+        want a pysat formula. None when the clauses were streamed into
+        the solver without being kept.
+        """
+        if self._clauses is None:
+            return None
+        return CNF(from_clauses=self._clauses, by_ref=True)
+
+    def _get_solver(self):
+        if self._solver is None:
+            self._solver = Solver(
+                name=SOLVER_BACKEND, bootstrap_with=self._clauses
+            )
+        return self._solver
+
+    def close(self):
+        """Release the underlying solver"""
+        if self._solver is not None:
+            self._solver.delete()
+            self._solver = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
 
     def _name(self, vars):
         """Decode VersionedPackages from corresponding variable numbers"""
@@ -54,87 +277,172 @@ class Formula:
             assumptions = []
         assumptions_vars = list(map(self.vp_to_var.__getitem__, assumptions))
 
-        with Solver(bootstrap_with=self.formula) as solver:
-            if not solver.solve(assumptions=assumptions_vars):
-                return False, None
-            vps = [self.var_to_vp[v] for v in solver.get_model() if v > 0]
+        solver = self._get_solver()
+        if not solver.solve(assumptions=assumptions_vars):
+            return False, None
+        model = solver.get_model()
 
+        # auxiliary variables of the at-most-one encoding don't
+        # correspond to any VersionedPackage, so they are skipped
+        vps = [
+            self.var_to_vp[v] for v in model if v > 0 and v in self.var_to_vp
+        ]
         setup = {vp.name: vp.version for vp in vps}
         return True, setup
 
     def any_satisfiable(self, packages: Iterable[VersionedPackage]):
         """Test whether at least one from packages can be satisfied"""
-        new_formula = self.formula.clauses + [
-            self.vp_to_var[vp] for vp in packages
-        ]
-        with Solver(bootstrap_with=new_formula) as solver:
-            return solver.solve()
+        vars = [self.vp_to_var[vp] for vp in packages]
+        if not vars:
+            return False
+
+        # One solve under a fresh selector variable s with the clause
+        # (-s | v_1 | ... | v_n): assuming s forces some v_i to hold, which
+        # is exactly "at least one of packages is in the setup". Note that
+        # assuming all v_i directly would instead demand all of them
+        # simultaneously — impossible for several versions of one package.
+        # The unit clause -s afterwards retracts the disjunction, keeping
+        # the solver reusable.
+        solver = self._get_solver()
+        self._top_id += 1
+        selector = self._top_id
+        solver.add_clause([-selector] + vars)
+        satisfiable = solver.solve(assumptions=[selector])
+        solver.add_clause([-selector])
+        return satisfiable
 
     @classmethod
-    def from_dependencies(cls, index, dependencies):
+    def from_dependencies(cls, index, dependencies, root_vp=None, solver=None):
         """Create formula characterizing valid setups
 
+        Arguments:
+            index, dependencies: result of load_package_index
+            root_vp (optional): if given, restrict the formula to versioned
+                packages transitively reachable from root_vp. Only those can
+                appear in a setup satisfying root_vp, so clauses over the
+                rest of the index would just bloat the CNF.
+            solver (optional): a pysat Solver to stream clauses into as they
+                are generated. Skips accumulating them in a Python list and
+                building an intermediate CNF; the returned Formula takes
+                ownership of the solver and runs its queries on it.
+
         Returns:
             formula (Formula)
         """
+        if root_vp is None:
+            vps = dependencies.keys()
+        else:
+            vps = _reachable(index, dependencies, root_vp)
 
         # There is a bijection between VersionedPackages and variables.
         # Set of variables with value 1 will correspond to VersionedPackages
         # in the setup.
-        bijection = dict(map(reversed, enumerate(dependencies.keys(), start=1)))
-
-        clauses = []
-        # Add clauses which prohibit several versions of the sae package
-        for package in index.keys():
-            vars = map(
-                lambda v: bijection[VersionedPackage(package, v)],
-                index[package],
-            )
-            for v1, v2 in combinations(vars, 2):
-                clauses.append([-v1, -v2])
-
-        # Add clauses which check that dependencies are satisfied
-        for vp, deps in dependencies.items():
-            for requirement, vs in deps.items():
-                possible_versions = vs.pick(index.get(requirement, {}))
-
-                # Either one of `possible_versions` is present in the setup,
-                clause = [
-                    bijection[VersionedPackage(requirement, v)]
-                    for v in possible_versions
-                ]
-                # ... or `vp` is absent
-                clause.append(-bijection[vp])
-                clauses.append(clause)
+        bijection = {vp: var for var, vp in enumerate(vps, start=1)}
+        # auxiliary variables (used by the at-most-one encoding below) are
+        # numbered after variables of versioned packages
+        next_id = len(bijection) + 1
+
+        # Two-level (name -> integer version -> variable) table: the clause
+        # loops below look variables up per version, and going through this
+        # table skips constructing and hashing a VersionedPackage each time.
+        var_of = {}
+        for vp, var in bijection.items():
+            var_of.setdefault(vp.name, {})[vp.version.v] = var
+
+        # No deduplication pass is needed before the solver: at-most-one
+        # clauses mention fresh auxiliary variables, and each dependency
+        # clause ends with the negated variable of its own vp (one clause
+        # per (vp, requirement) pair). The lone exception is a vp with
+        # several unsatisfiable requirements, which emits the unit clause
+        # [-var] once per such requirement; duplicate units are absorbed
+        # by the solver for free, so they aren't worth a dedup pass.
+        if solver is None:
+            clauses = []
+            emit = clauses.append
+        else:
+            emit = solver.add_clause
+
+        next_id = _version_uniqueness_clauses(var_of, next_id, emit)
+        _dependency_clauses(bijection, dependencies, var_of, emit)
+
+        if solver is not None:
+            return cls(None, bijection, solver=solver, top_id=next_id - 1)
+        # the raw clause list goes straight into the solver later; no CNF
+        # object is built unless someone reads Formula.formula
+        return cls(clauses, bijection, top_id=next_id - 1)
+
+
+def nest_dependencies(dependencies):
+    """Re-key dependencies as a name -> version -> requirements mapping
+
+    Looking a node up in the nested form is two plain dict hits instead of
+    constructing and hashing a VersionedPackage. Build it once when doing
+    many traversals over the same dependency mapping.
 
-        formula = CNF(from_clauses=clauses)
-        return cls(formula, bijection)
+    Returns:
+        nested (dict[str, dict[Version, dict[str, VersionSet]]])
+    """
+    nested = {}
+    for vp, deps in dependencies.items():
+        nested.setdefault(vp.name, {})[vp.version] = deps
+    return nested
 
 
-def reduce_setup(dependencies, setup: dict[str, Version], keep: Iterable[str]):
+def reduce_setup(
+    dependencies,
+    setup: dict[str, Version],
+    keep: Iterable[str],
+    nested=None,
+):
     """Reduce setup by removing everything except `keep` and its dependencies
 
     Arguments:
         dependencies (dict[VersionedPackage, dict[str, VersionSet]])
         setup (dict[str, Version]): setup to be reduced
         keep (Iterable[str]): package names to be kept
+        nested (optional): the view of `dependencies` built by
+            nest_dependencies. Callers reducing many setups over one
+            dependency mapping can pass it so the BFS below doesn't
+            construct a VersionedPackage per visited node.
 
     Returns:
         new_setup (dict[str, Version])
     """
-    if not set(keep).issubset(setup.keys()):
-        raise Exception("All packages from `keep` should be in the setup!")
-
-    new_setup_packages = set(keep)
-    queue = deque(keep)
-
+    new_setup_packages = set()
+    queue = deque()
+    # validation is folded into seeding the BFS, so `keep` is walked once
+    # and no second set is materialized just for the subset check
+    for package in keep:
+        if package not in setup:
+            raise Exception("All packages from `keep` should be in the setup!")
+        if package not in new_setup_packages:
+            new_setup_packages.add(package)
+            queue.append(package)
+
+    # when keep already covers the whole setup there is nothing to remove
+    total = len(setup)
+    if len(new_setup_packages) == total:
+        return dict(setup)
+
+    # bound methods avoid repeated attribute lookups in the BFS loop
+    pop = queue.popleft
+    push = queue.append
+    add = new_setup_packages.add
     while queue:
-        package = queue.popleft()
+        # the BFS can only add packages, so once everything is collected
+        # the rest of the traversal can't change the result
+        if len(new_setup_packages) == total:
+            break
+        package = pop()
         version = setup[package]
-        for requirement in dependencies[VersionedPackage(package, version)]:
+        if nested is None:
+            requirements = dependencies[VersionedPackage(package, version)]
+        else:
+            requirements = nested[package][version]
+        for requirement in requirements:
             if requirement not in new_setup_packages:
-                new_setup_packages.add(requirement)
-                queue.append(requirement)
+                add(requirement)
+                push(requirement)
     return {package: setup[package] for package in new_setup_packages}
 
 
@@ -142,7 +450,7 @@ def is_versionset_satisfiable(
     index, formula: Formula, package: str, vs: VersionSet
 ):
     """Check if there is solution of formula where `package` has version from vs"""
-    versions = vs.pick(index[package])
+    versions = vs.pick(index.get(package, ()))
     vps = [VersionedPackage(package, v) for v in versions]
 
     return formula.any_satisfiable(vps)
@@ -158,21 +466,29 @@ def satisfy(index, dependencies, package: str, version: str, oneline=False):
         )
     vp = VersionedPackage(package, version)
 
-    formula = Formula.from_dependencies(index, dependencies)
-
-    is_satisfiable, setup = formula.solve(assumptions=[vp])
-    if not is_satisfiable:
-        print("This package version can't be satisfied")
-
-        """
-        # We'll try to explain why:
-        # Check if for some dependency, none of versions in the
-        # corresponding versionset is satisfiable
-        for dep, vs in dependencies[vp].items():
-            if not is_versionset_satisfiable(index, formula, dep, vs):
-                print(f"None of versions {str(vs)} of dependency package {dep} is satisfiable!")
-        """
-        return
+    # clauses are streamed straight into the solver as they are generated,
+    # skipping the intermediate CNF object; the Formula keeps the solver
+    # alive so any follow-up queries reuse it
+    with Formula.from_dependencies(
+        index, dependencies, root_vp=vp, solver=Solver(name=SOLVER_BACKEND)
+    ) as formula:
+        is_satisfiable, setup = formula.solve(assumptions=[vp])
+
+        if not is_satisfiable:
+            print("This package version can't be satisfied")
+
+            # We'll try to explain why: check if for some dependency, none
+            # of versions in the corresponding versionset is satisfiable.
+            # Each check is a single incremental solve on the
+            # already-loaded solver, so the explanation costs one solver
+            # call per direct dependency instead of a rebuild.
+            for dep, vs in dependencies[vp].items():
+                if not is_versionset_satisfiable(index, formula, dep, vs):
+                    print(
+                        f"None of versions {str(vs)} of dependency"
+                        f" package {dep} is satisfiable!"
+                    )
+            return
 
     if oneline:
         setup = reduce_setup(dependencies, setup, [vp.name])
@@ -183,27 +499,28 @@ def satisfy(index, dependencies, package: str, version: str, oneline=False):
 
 
 def print_transitive_dependencies(
-    index, dependencies, setup: dict[str, Version], root_package: str
+    index, dependencies, setup: dict[str, Version], root_package: str, prefix="  "
 ):
     """Pretty-print to stdout root_package and all of its dependencies"""
     printed = set()
 
-    def pp(package: str, level: int, prefix="  "):
-        vp = VersionedPackage(package, setup[package])
+    # explicit stack instead of recursion: deep dependency chains don't hit
+    # the Python recursion limit, and `dependencies[vp]` is fetched once
+    # per node instead of once for the check and once for the iteration
+    stack = [(root_package, 0)]
+    while stack:
+        package, level = stack.pop()
+        version = setup[package]
         # dependencies do not necessarily form a tree, so cycles and
         # repeated subtrees should be prevented from printing
         if package in printed:
-            print(f"{prefix*level}{package} {vp.version} (see above)")
-            return
-
+            print(f"{prefix*level}{package} {version} (see above)")
+            continue
         printed.add(package)
 
-        has_subdependencies = (
-            " with following dependencies:" if dependencies[vp] else ""
-        )
-
-        print(f"{prefix*level}{package} {vp.version}{has_subdependencies}")
-        for dep in dependencies[vp]:
-            pp(dep, level + 1, prefix)
-
-    pp(root_package, 0)
+        deps = dependencies[VersionedPackage(package, version)]
+        has_subdependencies = " with following dependencies:" if deps else ""
+        print(f"{prefix*level}{package} {version}{has_subdependencies}")
+        # pushed in reverse so that they are printed in the original order
+        for dep in reversed(deps):
+            stack.append((dep, level + 1))
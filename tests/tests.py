@@ -83,6 +83,24 @@ def test_Formula():
     print("test_Formula passed tests!")
 
 
+def test_any_satisfiable():
+    f = Formula.from_dependencies(INDEX_TEST_CASE, DEPS_TEST_CASE)
+
+    # one satisfiable and one unsatisfiable version of the same package:
+    # must not demand both simultaneously
+    assert f.any_satisfiable([vp("a", 1), vp("a", 2)])
+    assert not f.any_satisfiable([vp("a", 2), vp("a", 3)])
+    assert not f.any_satisfiable([])
+
+    # repeated queries on one Formula: each selector must be retracted,
+    # otherwise earlier disjunctions would constrain later answers
+    assert f.any_satisfiable([vp("b", 1), vp("b", 2)])
+    assert not f.any_satisfiable([vp("b", 1)])
+    assert f.any_satisfiable([vp("a", 1), vp("a", 2)])
+
+    print("test_any_satisfiable passed tests!")
+
+
 def test_reduce_setup():
     f = Formula.from_dependencies(INDEX_TEST_CASE, DEPS_TEST_CASE)
 
@@ -102,4 +120,5 @@ def test_reduce_setup():
 def run():
     test_check_setup()
     test_Formula()
+    test_any_satisfiable()
     test_reduce_setup()